@@ -2,17 +2,116 @@
 # -*- coding: utf-8 -*-
 
 import atexit
+import concurrent.futures
+import functools
 import os
-from time import sleep
+import sys
+from time import monotonic, sleep
 
 import click
 import jinja2
 import requests
-from termcolor import colored
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 JENKINS_URL = None
-AUTH = None
+SESSION = None
+
+# ANSI colors, disabled when output isn't a terminal
+if sys.stdout.isatty():
+    GREEN, RED, YELLOW, RESET = '\x1b[32m', '\x1b[31m', '\x1b[33m', '\x1b[0m'
+else:
+    GREEN = RED = YELLOW = RESET = ''
+
+# Console 404s in a row before asking Jenkins whether build is still there
+MISSING_LOG_LIMIT = 10
+# Console 5xx in a row retried before watching gives up and aborts build
+SERVER_ERROR_LIMIT = 10
+
+_TEMPLATE_ENV = jinja2.Environment(autoescape=False)
+
+_LOG_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+atexit.register(_LOG_EXEC.shutdown, wait=True)
+
+
+@functools.lru_cache(maxsize=8)
+def _compile_template(src):
+    '''Parse and compile job template once per distinct content'''
+    return _TEMPLATE_ENV.from_string(src.decode('utf-8', 'surrogateescape'))
+
+
+def _json(res):
+    '''Decode JSON body of response, with orjson when it's installed'''
+    if orjson is None:
+        return res.json()
+    return orjson.loads(res.content)
+
+
+def _write_log_sync(filename, content):
+    '''Write log file, creating logs directory if needed'''
+    if not os.path.isdir('./logs'):
+        os.mkdir('./logs')
+
+    log_file = open(filename, 'w')
+    log_file.write(content)
+    log_file.close()
+
+
+def _report_log_error(future):
+    '''Print why background log writing failed, it's lost otherwise'''
+    error = future.exception()
+    if error is not None:
+        msg = '> Unable to write log: {}'.format(error)
+        print(msg, file=sys.stderr, flush=True)
+
+
+def _iter_lines(res, chunk_size=8192):
+    '''Yield lines of streamed response, CRLF split by chunks kept whole'''
+    pending = b''
+    for chunk in res.iter_content(chunk_size=chunk_size):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line[:-1] if line.endswith(b'\r') else line
+
+    if pending:
+        yield pending[:-1] if pending.endswith(b'\r') else pending
+
+
+class _Backoff:
+    '''Sleep growing exponentially while nothing changes on server'''
+
+    def __init__(self, initial=0.1, cap=2.0):
+        self.initial = initial
+        self.cap = cap
+        self.delay = initial
+
+    def wait(self):
+        sleep(self.delay)
+        self.delay = min(self.delay * 2, self.cap)
+
+    def reset(self):
+        self.delay = self.initial
+
+
+def _poll(url, *, initial=0.1, cap=2.0):
+    '''Yield GET responses for url, backing off while the body stays the same'''
+    backoff = _Backoff(initial, cap)
+    previous = None
+
+    while True:
+        res = SESSION.get(url)
+        if res.content != previous:
+            backoff.reset()
+        previous = res.content
+
+        yield res
+        backoff.wait()
 
 
 @click.group()
@@ -49,18 +148,24 @@ def cli(jenkins_url, jenkins_user, jenkins_password):
         Invocation without commands do nothing
     """
     globals()['JENKINS_URL'] = jenkins_url
-    globals()['AUTH'] = requests.auth.HTTPBasicAuth(jenkins_user, jenkins_password)
-    pass
+
+    # One keep-alive pool for all requests, polling loops reuse its sockets
+    session = requests.Session()
+    session.auth = requests.auth.HTTPBasicAuth(jenkins_user, jenkins_password)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    globals()['SESSION'] = session
 
 @cli.command()
 @click.argument(
     'jenkinsfile',
-    type=click.File('r'),
+    type=click.File('rb'),
     required=True
 )
 @click.argument(
     'templatefile',
-    type=click.File('r'),
+    type=click.File('rb'),
     required=True,
     default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template_job.xml')
 )
@@ -115,7 +220,7 @@ def build(jenkinsfile, templatefile, keep, verbose, yes, force):
     job.validate()
     if not yes:
         msg = '> Press Enter to continue or Ctrl+C to exit'
-        input(colored(msg, 'green'))
+        input(GREEN + msg + RESET)
 
     job.create(force)
     if not keep:
@@ -131,7 +236,7 @@ def build(jenkinsfile, templatefile, keep, verbose, yes, force):
 @cli.command()
 @click.argument(
     'script',
-    type=click.File('r'),
+    type=click.File('rb'),
     required=True
 )
 def script(script):
@@ -140,21 +245,20 @@ def script(script):
 
         SCRIPT - File with script. Should end on '.groovy'.
     '''
-    script_content = script.read()
-    script.close()
     data = {
-        'script': script_content,
+        'script': script.read(),
     }
+    script.close()
 
     url = '{}/scriptText'.format(JENKINS_URL)
 
-    res = requests.post(url, data=data, auth=AUTH)
+    res = SESSION.post(url, data=data)
 
     if res.status_code != 200:
         msg = "> Script execution failed with code {}".format(res.status_code)
-        print(colored(msg,'red'))
+        print(RED + msg + RESET)
         msg = "> Response:"
-        print(colored(msg,'red'))
+        print(RED + msg + RESET)
         print(res.text)
         exit(1)
 
@@ -179,137 +283,144 @@ class JenkinsJob:
         self.build_number = None
         self.build_url = None
         self.queue_url = None
+        self._log_offset = 0
+
+        self._queue_api_url = None
+        self._status_url = None
+        self._console_url = None
+        self._result_url = None
 
     def validate(self):
         '''Validate pipeline part of this taks on server'''
 
         msg = '> Validating...'
-        print(colored(msg, 'green'))
+        print(GREEN + msg + RESET)
 
         url = '{}/pipeline-model-converter/validate'.format(JENKINS_URL)
         data = {'jenkinsfile': self.jenkinsfile_content}
-        res = requests.post(
-            url,
-            auth=AUTH,
-            data=data)
+        res = SESSION.post(url, data=data)
 
         msg = '> Validation response:'
-        print(colored(msg, 'green'))
+        print(GREEN + msg + RESET)
         print(res.text, end='')
 
     def create(self, force):
         '''Create this taks on server'''
         if force:
-            url = ('{}/job/debug/job/{}/config.xml'
-                .format(JENKINS_URL, self.name))
-            res = requests.get(url, auth=AUTH)
-            if res.status_code != 404:
-                self.delete()
+            self.delete(missing_ok=True)
 
-        template = jinja2.Template(self.template_content)
-        filled_template = template.render(
-            jenkinsfile=self.jenkinsfile_content)
+        filled_template = _compile_template(self.template_content).render(
+            jenkinsfile=self.jenkinsfile_content.decode(
+                'utf-8', 'surrogateescape'))
 
         headers = {'Content-Type': 'text/xml'}
         params = {'name': self.name}
         url = '{}/job/debug/createItem'.format(JENKINS_URL)
-        res = requests.post(
+        res = SESSION.post(
             url,
             headers=headers,
-            data=filled_template.encode('utf-8'),
-            params=params,
-            auth=AUTH
+            # Bytes that aren't UTF-8 are passed through as they were read
+            data=filled_template.encode('utf-8', 'surrogateescape'),
+            params=params
         )
 
         if res.status_code != 200:
             msg = "> Unable to create '{}' job".format(self.name)
-            print(colored(msg,'red'))
+            print(RED + msg + RESET)
 
             log_filename = self._log('create', res.text)
 
             msg = "> See '{}' for additional info".format(log_filename)
-            print(colored(msg, 'red'))
+            print(RED + msg + RESET)
 
             exit(1)
 
         msg = "> Job '{}' created".format(self.name)
-        print(colored(msg, 'green'))
+        print(GREEN + msg + RESET)
 
-    def delete(self):
+    def delete(self, missing_ok=False):
         '''Delete this taks on server'''
         url = '{}/job/debug/job/{}/doDelete'.format(JENKINS_URL, self.name)
-        res = requests.post(url, auth=AUTH)
+        res = SESSION.post(url)
+
+        # Jenkins answers 404 on doDelete for a job that doesn't exist
+        if missing_ok and res.status_code == 404:
+            return
 
         if res.status_code != 200:
             msg = "> Unable to delete '{}' job".format(self.name)
-            print(colored(msg, 'red'))
+            print(RED + msg + RESET)
 
             log_filename = self._log('delete', res.text)
 
             msg = "> See '{}' for additional info".format(log_filename)
-            print(colored(msg, 'red'))
+            print(RED + msg + RESET)
 
             exit(1)
 
         msg = "> Job '{}' deleted".format(self.name)
-        print(colored(msg, 'green'))
+        print(GREEN + msg + RESET)
 
     def start(self):
         '''Start this taks on server'''
         msg = '> Starting...'
-        print(colored(msg, 'green'))
+        print(GREEN + msg + RESET)
 
         url = '{}/job/debug/job/{}/build'.format(JENKINS_URL, self.name)
-        res = requests.post(url, auth=AUTH)
+        res = SESSION.post(url)
 
         if res.status_code != 201:
             msg = '> Something goes wrong'
-            print(colored(msg, 'red'))
+            print(RED + msg + RESET)
             print(res.text)
 
         self.queue_url = res.headers['location']
+        self._queue_api_url = '{}{}'.format(self.queue_url,
+            'api/json?tree=executable[number,url],why')
         self._set_build_number()
 
     def _set_build_number(self):
         if self.queue_url is None:
             raise RuntimeError('No queue url - build was not scheduled')
 
-        waiting = True
         carriage_return_printed = False
-        waiting_time = 0
+        waiting_since = monotonic()
 
-        while waiting:
-            url = '{}{}'.format(self.queue_url, 'api/json')
-            res = requests.get(url)
+        for res in _poll(self._queue_api_url):
+            data = _json(res)
+            executable = data.get('executable')
+            if executable is None:
+                reason = data.get('why') or 'Unknown'
 
-            if res.json().get('executable') is None:
-                reason = 'Unknown'
-                if res.json().get('why') is not None:
-                    reason = res.json().get('why')
-
-                if waiting_time >= 9:
+                waiting_time = monotonic() - waiting_since
+                if waiting_time >= 0.9:
                     # TODO: Добавить время ожидания
                     msg = ('\r> Waiting in queue for {} seconds. Reason: {}'
-                        .format(int(waiting_time / 10), reason))
-                    print(colored(msg, 'yellow'), end='', flush=True)
+                        .format(int(waiting_time), reason))
+                    sys.stdout.write(YELLOW + msg + RESET)
+                    sys.stdout.flush()
                     carriage_return_printed = True
 
-                sleep(0.1)
-                waiting_time += 1
                 continue
 
             if carriage_return_printed:
                 print('')
 
             msg = "> Building '{}' started".format(self.name)
-            print(colored(msg, 'green'))
-
-            waiting = False
+            print(GREEN + msg + RESET)
 
-            self.build_number = res.json().get('executable').get('number')
-            self.build_url = res.json().get('executable').get('url')
+            self.build_number = executable['number']
+            self.build_url = executable['url']
             self.queue_url = None
 
+            self._status_url = '{}{}'.format(
+                self.build_url, 'api/json?tree=building')
+            self._console_url = '{}{}'.format(
+                self.build_url, 'logText/progressiveText')
+            self._result_url = '{}{}'.format(
+                self.build_url, 'api/json?tree=result')
+            break
+
     def _get_queue_number(self):
         if self.queue_url is None:
             return None
@@ -320,110 +431,149 @@ class JenkinsJob:
     def stop(self):
         '''Stop this task on server'''
         if self._get_queue_number() is not None:
-            res = requests.post(
+            res = SESSION.post(
                 '{}/queue/cancelItem'.format(JENKINS_URL),
-                data={'id': int(self._get_queue_number())},
-                auth=AUTH
+                data={'id': int(self._get_queue_number())}
             )
             msg = ("> '{}' stopped from queue, HTTP code: {}"
                 .format(self.name, res.status_code))
-            print(colored(msg, 'green'))
+            print(GREEN + msg + RESET)
             return
 
         if self.build_url is not None:
-            res = requests.post(
-                '{}/stop'.format(self.build_url),
-                auth=AUTH
-            )
+            res = SESSION.post('{}/stop'.format(self.build_url))
             msg = ("> '{}' abort request sended. Waiting for stop..."
                 .format(self.name))
-            print(colored(msg, 'green'))
+            print(GREEN + msg + RESET)
 
-            url = '{}/api/json'.format(self.build_url)
-            stopped = False
-            while not stopped:
-                sleep(0.1)
-                res = requests.get(url, auth=AUTH)
-                if not res.json().get('building'):
-                    stopped = True
+            for res in _poll(self._status_url):
+                if res.status_code != 200 or not _json(res).get('building'):
+                    break
 
             msg = ("> '{}' stopped"
                 .format(self.name))
-            print(colored(msg, 'green'))
+            print(GREEN + msg + RESET)
             return
 
         msg = "> Building '{}' job already stopped".format(self.name)
-        print(colored(msg, 'green'))
+        print(GREEN + msg + RESET)
+
+    def _is_building(self):
+        res = SESSION.get(self._status_url)
+        if res.status_code != 200:
+            return False
+
+        return bool(_json(res).get('building'))
 
     def watch_stream(self, verbose):
-        start_at = 0
         stream_open = True
         check_job_status = 0
-        console = requests.session()
-
-        console_url = '{}{}'.format(self.build_url, 'logText/progressiveText')
-        status_url = '{}{}'.format(self.build_url, 'api/json')
-
-        print(colored('> Attempting to get console output:', 'green'))
-        print('')
+        backoff = _Backoff()
+
+        if verbose:
+            should_skip = lambda line: False
+        else:
+            should_skip = lambda line, _m=b'[Pipeline]': _m in line
+        stdout = sys.stdout.buffer
+        missing_log_count = 0
+        server_error_count = 0
+        build_over = False
+
+        print(GREEN + '> Attempting to get console output:' + RESET)
+        print('', flush=True)
         while stream_open:
-            res = requests.get(status_url, auth=AUTH)
-            build_going = res.json().get('building')
-
-            if not build_going:
-                stream_open = False
-
-            res = console.post(console_url,
-                data={'start': start_at},
-                auth=AUTH)
-
-            content_length = int(res.headers.get('Content-Length', -1))
+            res = SESSION.post(self._console_url,
+                data={'start': self._log_offset},
+                stream=True)
 
             # Прикольное состояние, когда билд уже не в queue,
             #   но ещё не начался
             if res.status_code == 404:
+                res.close()
+                if build_over:
+                    msg = ("> Build '{}' is not running, console output "
+                        "is unavailable".format(self.name))
+                    print(RED + msg + RESET)
+                    break
+
+                missing_log_count += 1
+                if missing_log_count >= MISSING_LOG_LIMIT:
+                    # Status goes before console: the next console read
+                    #   happens after the build is over and gets all output
+                    build_over = not self._is_building()
+                    missing_log_count = 0
+
+                if not build_over:
+                    backoff.wait()
                 continue
 
+            missing_log_count = 0
+
+            # Proxies in front of Jenkins may fail now and then, retry those
+            if 500 <= res.status_code < 600:
+                server_error_count += 1
+                if server_error_count < SERVER_ERROR_LIMIT:
+                    res.close()
+                    msg = ('> Console request failed with code {}, '
+                        'retrying...'.format(res.status_code))
+                    print(YELLOW + msg + RESET)
+                    backoff.wait()
+                    continue
+
             if res.status_code != 200:
                 msg = '> Something goes wrong'
-                print(colored(msg, 'red'))
+                print(RED + msg + RESET)
                 print(res.content)
-                print(res.headers)
-
-            if content_length == 0:
-                sleep(0.1)
-                continue
-
-            for line in res.text.splitlines():
-                if verbose:
-                    print(line)
-                    continue
-
-                if '[Pipeline]' in line:
-                    continue
-
-                print(line)
-
-            start_at = int(res.headers.get('X-Text-Size'))
-            sleep(0.1)
-
-        res = requests.get(status_url, auth=AUTH)
-        build_result = res.json().get('result')
+                print(res.headers, flush=True)
+                return 1
+
+            server_error_count = 0
+
+            # Jenkins sets this header while the log can still grow,
+            #   so no separate build status request is needed
+            stream_open = res.headers.get('X-More-Data') == 'true'
+
+            # Decide on headers only, empty chunks are never read
+            if res.headers.get('Content-Length') == '0':
+                res.close()
+            else:
+                keep_lines = [
+                    line for line in _iter_lines(res)
+                    if not should_skip(line)]
+                if keep_lines:
+                    stdout.write(b'\n'.join(keep_lines) + b'\n')
+                    stdout.flush()
+
+            # Log size moves only on new output, chunked empty replies
+            #   have no Content-Length to tell them apart
+            text_size = int(res.headers['X-Text-Size'])
+            if text_size != self._log_offset:
+                self._log_offset = text_size
+                backoff.reset()
+
+            if stream_open:
+                backoff.wait()
+
+        res = SESSION.get(self._result_url)
+        build_result = None
+        if res.status_code == 200:
+            build_result = _json(res).get('result')
         print('')
         msg = '> Build ended with result: {}'.format(build_result)
-        print(colored(msg, 'green'))
+        print(GREEN + msg + RESET)
 
         return 0
 
     def _log(self, log_descripton, log_content):
-        if not os.path.isdir('./logs'):
-            os.mkdir('./logs')
-
         filename = './logs/{}_{}_log.html'.format(self.name, log_descripton)
 
-        log_file = open(filename, 'w')
-        log_file.write(log_content)
-        log_file.close()
+        try:
+            future = _LOG_EXEC.submit(_write_log_sync, filename, log_content)
+            future.add_done_callback(_report_log_error)
+        except RuntimeError:
+            # Executor refuses new work once interpreter is shutting down,
+            #   e.g. when called from delete/stop atexit handlers
+            _write_log_sync(filename, log_content)
 
         return filename
 